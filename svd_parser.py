@@ -1,449 +1,596 @@
 from pathlib import Path
-import xml.etree.ElementTree as Et
+from contextlib import nullcontext
+from itertools import chain
+from operator import itemgetter
 import argparse
+import functools
 import json
+import os
+import re
+import shutil
 import subprocess
+import sys
 
+try:
+    from lxml import etree as Et
+    LXML = True
+except ImportError:
+    import xml.etree.ElementTree as Et
+    LXML = False
 
-def get_derived_index(derived: str, peripherals: list):
-    for i in range(len(peripherals)):
-        addresses = peripherals[i]['derived']
-        for address in addresses:
-            if derived == address['name']:
-                return i
-    return None
+try:
+    import orjson
+    ORJSON = True
+except ImportError:
+    ORJSON = False
+
+# Pool machinery is imported only when a pool is started, type checkers still see Executor for annotations
+TYPE_CHECKING = False
+if TYPE_CHECKING:
+    from concurrent.futures import Executor
+
+
+# Register and field access, missing access means read-write, anything unknown write-only
+ACCESS = {None: 'RW', 'read-write': 'RW', 'read-only': 'RO', 'write-only': 'WO'}
+
+# Storage type of register in simulation, by register width
+CTYPES = {8: 'uint8_t', 16: 'uint16_t', 32: 'uint32_t'}
+
+# Line break together with indentation of the next line
+LINE_BREAK = re.compile(r'\n[ \t]*')
+
+
+# Text of optional element, default when element or its text is missing
+def get_text(element: Et.Element, default: str = ''):
+    return default if element is None or element.text is None else element.text
+
+
+# Text of required element, positions have no sensible default and a guess would shift the map
+def get_required_text(children: dict, tag: str, owner: str):
+    element = children.get(tag)
+    if element is None or not element.text:
+        raise ValueError(f'{owner} has no {tag}')
+    return element.text
 
 
 def process_description(description: str):
-    while True:
-        begin = description.find('\n')
-        if begin != -1:
-            end = begin
-            for i in range(begin + 1, len(description)):
-                if description[i] != ' ':
-                    end = i
-                    break
-            temp = description[:begin] + description[end - 1:]
-            description = temp
-        else:
-            break
-    return description
+    return LINE_BREAK.sub(' ', (description or '').capitalize())
 
 
+# Values depend on width only, so build each list once and share it between fields
+@functools.cache
 def process_values(width: int):
-    values = []
-    if width < 4:
-        for i in range(0, int(pow(2,width))):
-            name = f'Value{i}'
-            description = f'Some description of {name}'
-            values.append({'name': name, 'description': description, 'value': i})
-    return values
+    if width >= 4:
+        return ()
+    return tuple({'name': f'Value{i}', 'lower': f'value{i}', 'description': f'Some description of Value{i}', 'value': i} for i in range(1 << width))
 
 
-def process_fields(register: str, tree: Et.Element):
+def process_fields(peripheral: str, register: str, tree: Et.Element):
     fields = []
     if tree is not None:
         for branch in tree:
-            name = branch.find('name').text.upper()
-            description = process_description(branch.find('description').text.capitalize())
-            offset = int(branch.find('bitOffset').text, 10)
-            width = int(branch.find('bitWidth').text, 10)
-            access = 'RW' if branch.find('access') is None or branch.find('access').text == 'read-write' else 'RO' if branch.find('access').text == "read-only" else 'WO'
+            children = {child.tag: child for child in branch}
+            name = children['name'].text.upper()
+            description = process_description(get_text(children.get('description')))
+            offset = int(get_required_text(children, 'bitOffset', f'Field {peripheral}.{register}.{name}'), 10)
+            width = int(get_required_text(children, 'bitWidth', f'Field {peripheral}.{register}.{name}'), 10)
+            access = ACCESS.get(get_text(children.get('access'), None), 'WO')
             values = process_values(width)
             if register != name:
-                fields.append({'name': name,  'description': description, 'offset': offset, 'width': width, 'access': access, 'values': values })
+                fields.append({'name': name, 'lower': name.lower(), 'description': description, 'offset': offset, 'width': width, 'access': access, 'values': values })
     return fields
 
 
-def process_registers(tree: Et.Element):
+def process_registers(peripheral: str, tree: Et.Element):
     registers = []
     if tree is not None:
         for branch in tree:
-            name = branch.find('name').text.upper()
-            description = process_description(branch.find('description').text.capitalize())
-            offset = '0' if int(branch.find('addressOffset').text, 16) == 0 else f'0x{int(branch.find('addressOffset').text, 16):02X}'
-            width = int(branch.find('size').text, 16)
-            length = 0 if branch.attrib == {} else int(branch.attrib['array'])
-            access = 'RW' if branch.find('access') is None or branch.find('access').text == 'read-write' else 'RO' if branch.find('access').text == "read-only" else 'WO'
-            fields = process_fields(name, branch.find('fields'))
-            registers.append({ 'name': name, 'description': description, 'offset': offset, 'width': width, 'length': length, 'access': access, 'fields': fields })
+            children = {child.tag: child for child in branch}
+            name = children['name'].text.upper()
+            description = process_description(get_text(children.get('description')))
+            offset = int(get_required_text(children, 'addressOffset', f'Register {peripheral}.{name}'), 16)
+            width = int(children['size'].text, 0)
+            length = int(branch.get('array', 0))
+            access = ACCESS.get(get_text(children.get('access'), None), 'WO')
+            fields = process_fields(peripheral, name, children.get('fields'))
+            ctype = CTYPES.get(width, 'uint32_t')
+            registers.append({ 'name': name, 'lower': name.lower(), 'description': description, 'offset': offset, 'width': width, 'ctype': ctype, 'length': length, 'access': access, 'fields': fields })
     return registers
 
 
 def generate_names(peripheral: str, elements: list):
-    text = ''
+    names = []
     for element in elements:
         name = element['name']
-        name_str = f'{name.lower()}_name[]'
+        name_str = f'{element['lower']}_name[]'
         if peripheral == '':
-            text += f'static inline char {name_str} = "{name}";\n'
+            names.append(f'static inline char {name_str} = "{name}";')
         else:
-            text += f'static inline char {name_str} = "{peripheral}::{name}";\n'
-    return '' if not len(elements) else text[:-1]
+            names.append(f'static inline char {name_str} = "{peripheral}::{name}";')
+    return '\n'.join(names)
+
+
+# Files per clang-format call, keeps the command line far below the Windows limit of 32767 characters
+CLANG_FORMAT_BATCH = 256
+
+
+def run_clang_format(files: list, cwd: Path):
+    if not files:
+        return
+
+    # Prefer clang-format from PATH, then the default LLVM install location on Windows
+    clang_format = shutil.which('clang-format') or shutil.which('C:/Program Files/LLVM/bin/clang-format.exe')
+    if clang_format is None:
+        sys.stderr.write('clang-format is not found, generated files are left unformatted\n')
+        return
+
+    # Point clang-format to the style directly instead of searching it for every file
+    style = cwd / '.clang-format'
+    style = f'--style=file:{style.resolve().as_posix()}' if style.is_file() else '--style=file'
+    files = [Path(file).relative_to(cwd).as_posix() for file in files]
+    for i in range(0, len(files), CLANG_FORMAT_BATCH):
+        subprocess.run([clang_format, style, '-i', *files[i:i + CLANG_FORMAT_BATCH]], cwd=cwd, check=True)
+
+
+def write_header(path: Path, text: str):
+    # Small headers are encoded at once and written in a single call, as UTF-8 with native line endings like other headers
+    path.write_bytes(text.replace('\n', os.linesep).encode('utf-8'))
+
+
+# Fewer peripherals than this are generated faster without a process pool
+PARALLEL_MIN_PERIPHERALS = 16
+
+
+def map_peripherals(function, peripherals: list, executor: 'Executor | None'):
+    if executor is None:
+        return list(map(function, peripherals))
+    # Send peripherals in a few big chunks per worker instead of one round-trip each
+    chunksize = max(1, len(peripherals) // (4 * (os.cpu_count() or 1)))
+    return list(executor.map(function, peripherals, chunksize=chunksize))
+
+
+# Buffer size for generated headers, keeps big headers in a few write calls
+WRITE_BUFFER = 1 << 20
+
+# Templates of base file lines, filled from register dict
+REGISTER_ADDRESS = 'auto {lower}_address = {begin} + 0x{offset:02X}'
+REGISTER_ARRAY_TYPE = 'using {name}_t = RegisterArray<{lower}_address, {width}, {length}, {access}, Target, STM32F4xxx, {lower}_name>;\t// {description}\n'
+REGISTER_ARRAY = 'static inline {name}_t {name};\t// {description}\n'
+REGISTER_PACK = '\t\ttemplate<typename... T> using {name}Pack = RegisterPack<{name}, T...>;\t// {description} pack'
+REGISTER = 'using {name} = RegisterBase<{lower}_address, {width}, {length}, {access}, Target, STM32F4xxx, {lower}_name>;\t// {description}\n'
+REGISTER_CLASS = (
+    '// {description}\n'
+    'class {name}: public RegisterBase<{lower}_address, {width}, {length}, {access}, Target, STM32F4xxx, {lower}_name>\n'
+    '{{\n'
+    '{names}\n'
+    'public:\n'
+    '{fields}\n'
+    '}};\n'
+)
+REGISTER_FIELD = 'using {name} = {register}_{name}<{register}, {offset}, {width}, {access}, Target, STM32F4xxx, {lower}_name>;\t// {description}\n'
+
+# Templates of field file lines, values are the most numerous so they use plain % formatting
+FIELD_VALUE = 'using %s = ValueBase<%s, %d, Target, Family, %s_name>;\t// %s\n'
+FIELD_CLASS = (
+    '// {description}\n'
+    'template<class Register, size_t offset, size_t width, class Access, class Target, class Family, const char* name>\n'
+    'class {name}: public FieldBase<Register, offset, width, Access, Target, Family, name>\n'
+    '{{\n'
+    '{names}\n'
+    'public:\n'
+    '{values}\n'
+    '}};\n'
+)
+FIELD_EMPTY_CLASS = (
+    '// {description}\n'
+    'template<class Register, size_t offset, size_t width, class Access, class Target, class Family, const char* name>\n'
+    'class {name}: public FieldBase<Register, offset, width, Access, Target, Family, name>\n'
+    '{{\n'
+    '}};\n'
+)
+
+
+def create_base_file(peripheral: dict, namespace: str, config: dict):
+    registers = peripheral['registers']
+
+    # Generate register name variables
+    register_names = generate_names(peripheral['name'], registers)
+
+    addresses = []
+    array_types = []
+    arrays = []
+    packs = []
+    registers_str = []
+    begin = f'{registers[0]['lower']}_address' if registers else ''
+    for i, register in enumerate(registers):
 
+        # Generate address list for base template
+        if i == 0:
+            addresses.append(f'auto {begin}')
+        else:
+            addresses.append(REGISTER_ADDRESS.format_map(dict(register, begin=begin)))
 
-def run_clang_format(file: Path):
-    subprocess.call(
-        ['C:/Program Files/LLVM/bin/clang-format.exe', '--style=file', '-i', str(file).replace('\\','/')])
+        if register['length']:
+            # Generate types for arrays of registers and static array registers
+            array_types.append(REGISTER_ARRAY_TYPE.format_map(register))
+            arrays.append(REGISTER_ARRAY.format_map(register))
+            continue
 
+        # Generate register packs
+        packs.append(REGISTER_PACK.format_map(register))
 
-def create_base_files(namespace: str, peripherals: list, config: dict):
-    Path(config['root']['base']).mkdir(parents=True, exist_ok=True)
-    for peripheral in peripherals:
-        registers = peripheral['registers']
+        # Generate registers, if empty fields or width of register = width of field
+        if len(register['fields']) == 0 or register['width'] == register['fields'][0]['width']:
+            registers_str.append(REGISTER.format_map(register))
 
-        # Generate address list for base template
-        addresses = ''
-        for i, register in enumerate(registers):
-            begin = f'{registers[0]['name'].lower()}_address'
-            if i == 0:
-                addresses += f'auto {begin},\n'
-            else:
-                addresses += f'auto {register['name'].lower()}_address = {begin} + 0x{int(register['offset'], 16):02X},\n'
+        else:
+            # Generate fields name
+            names = generate_names('', register['fields'])
 
-        # Generate register name variables
-        register_names = generate_names(peripheral['name'], peripheral['registers'])
+            # Generate fields
+            fields = []
+            for field in register['fields']:
+                fields.append(REGISTER_FIELD.format_map(dict(field, register=register['name'])))
+            fields = ''.join(fields)
 
-        # Generate types for arrays of registers
-        array_types = ''
-        for register in registers:
-            if register['length']:
-                array_types += f'using {register['name']}_t = RegisterArray<{register['name'].lower()}_address, {register['width']}, {register['length']}, {register['access']}, Target, STM32F4xxx, {register['name'].lower()}_name>;\t// {register['description']}\n'
+            registers_str.append(REGISTER_CLASS.format_map(dict(register, names=names, fields=fields)))
 
-        # Generate static array registers
-        arrays = ''
-        for register in registers:
-            if register['length']:
-                arrays += f'static inline {register['name']}_t {register['name']};\t// {register['description']}\n'
+    addresses = ',\n'.join(addresses)
+    packs = '\n'.join(packs)
 
-        # Generate register packs
-        packs = ''
-        for register in registers:
-            if not register['length']:
-                packs += f'\t\ttemplate<typename... T> using {register['name']}Pack = RegisterPack<{register['name']}, T...>;\t// {register['description']} pack\n'
-
-        # Generate registers
-        registers_str = ''
-        for register in registers:
-
-            # If empty fields or width of register = width of field
-            if register['length'] == 0:
-                if len(register['fields']) == 0 or register['width'] == register['fields'][0]['width']:
-                    registers_str += f'using {register['name']} = RegisterBase<{register['name'].lower()}_address, {register['width']}, {register['length']}, {register['access']}, Target, STM32F4xxx, {register['name'].lower()}_name>;\t// {register['description']}\n'
-
-                else:
-                    # Generate fields name
-                    names = generate_names('', register['fields'])
-
-                    # Generate fields
-                    fields = ''
-                    for field in register['fields']:
-                        fields += f'using {field['name']} = {register['name']}_{field['name']}<{register['name']}, {field['offset']}, {field['width']}, {field['access']}, Target, STM32F4xxx, {field['name'].lower()}_name>;\t// {field['description']}\n'
-
-                    registers_str += (
-                        f'// {register['description']}\n'
-                        f'class {register['name']}: public RegisterBase<{register['name'].lower()}_address, {register['width']}, {register['length']}, {register['access']}, Target, STM32F4xxx, {register['name'].lower()}_name>\n'
-                        f'{{\n'
-                        f'{names}\n'
-                        f'public:\n'
-                        f'{fields}\n'
-                        f'}};\n'
-                    )
-
-        if array_types != '':
-            register_names += '\n'
-
-        text = (
-            f'#pragma once\n\n'
-            f'#include "{config['base']['common']}/RegisterBase.h"\n'
-            f'#include "{config['base']['common']}/RegisterPack.h"\n'
-            f'#include "{config['base']['common']}/RegisterArray.h"\n'
-            f'#include "{config['base']['common']}/FieldBase.h"\n'
-            f'#include "{config['base']['common']}/ValueBase.h"\n'
-            f'#include "{config['base']['fields']}/{peripheral['name']}.h"\n'
-            f'#include "{config['base']['root']}/{config['targets']}"\n'
-            f'namespace {namespace}::{peripheral['name'].lower()}\n'
-            f'{{\n'
-            f'// {peripheral['description']}\n'
-            f'template<class Target, {addresses[:-2]}>\n'
-            f'class {peripheral['name']}Base\n'
-            f'{{\n'
-            f'{register_names}\n'
-            f'{array_types}'
-            f'public:\n'
-            f'{registers_str}\n'
-            f'{arrays}'
-            f'\n// clang-format off\n'
-            f'{packs[:-1]}\n'
-            f'// clang-format on\n'
-            f'}};\n'
-            f'}}\n'
-        )
+    if array_types:
+        register_names += '\n'
 
-        path = Path('.').cwd()/f'{config['root']['base']}/{peripheral['name']}.h'
-        with open(path, 'w') as header:
-            header.write(text)
+    # Sections without separators are written part by part
+    text = chain((
+        f'#pragma once\n\n'
+        f'#include "{config['base']['common']}/RegisterBase.h"\n'
+        f'#include "{config['base']['common']}/RegisterPack.h"\n'
+        f'#include "{config['base']['common']}/RegisterArray.h"\n'
+        f'#include "{config['base']['common']}/FieldBase.h"\n'
+        f'#include "{config['base']['common']}/ValueBase.h"\n'
+        f'#include "{config['base']['fields']}/{peripheral['name']}.h"\n'
+        f'#include "{config['base']['root']}/{config['targets']}"\n'
+        f'namespace {namespace}::{peripheral['name'].lower()}\n'
+        f'{{\n'
+        f'// {peripheral['description']}\n'
+        f'template<class Target, {addresses}>\n'
+        f'class {peripheral['name']}Base\n'
+        f'{{\n'
+        f'{register_names}\n',
+    ), array_types, (
+        'public:\n',
+    ), registers_str, (
+        '\n',
+    ), arrays, (
+        f'\n// clang-format off\n'
+        f'{packs}\n'
+        f'// clang-format on\n'
+        f'}};\n'
+        f'}}\n',
+    ))
+
+    path = config['cwd'] / config['root']['base'] / f'{peripheral['name']}.h'
+    with open(path, 'w', encoding='utf-8', buffering=WRITE_BUFFER) as header:
+        header.writelines(text)
+
+    return path
+
+
+def create_base_files(namespace: str, peripherals: list, config: dict, executor: 'Executor | None'):
+    return map_peripherals(functools.partial(create_base_file, namespace=namespace, config=config), peripherals, executor)
+
+
+def create_field_file(peripheral: dict, namespace: str, config: dict):
+    # Generate fields structs
+    fields = []
+    for register in peripheral['registers']:
+        for field in register['fields']:
+            name = f'{register['name']}_{field['name']}'
 
-    path = Path('.').cwd() / f'{config['root']['base']}/*.h'
-    run_clang_format(path)
+            # Generate values names
+            names = generate_names('', field['values'])
 
+            # Generate values structs
+            values = ''.join(
+                FIELD_VALUE % (value['name'], name, value['value'], value['lower'], value['description'])
+                for value in field['values'])
 
-def create_field_files(namespace: str, peripherals: list, config: dict):
-    Path(config['root']['fields']).mkdir(parents=True, exist_ok=True)
-    for peripheral in peripherals:
-        # Generate fields structs
-        fields = ''
-        for register in peripheral['registers']:
-            for field in register['fields']:
-                name = f'{register['name']}_{field['name']}'
+            if len(field['values']):
+                fields.append(FIELD_CLASS.format(name=name, description=field['description'], names=names, values=values))
+            else:
+                fields.append(FIELD_EMPTY_CLASS.format(name=name, description=field['description']))
 
-                # Generate values names
-                names = generate_names('', field['values'])
+    text = chain((
+        f'#pragma once\n\n'
+        f'#include "{config['fields']['common']}/FieldBase.h"\n'
+        f'#include "{config['fields']['common']}/ValueBase.h"\n'
+        f'namespace {namespace}::{peripheral['name'].lower()}\n'
+        f'{{\n',
+    ), fields, (
+        '\n'
+        '}\n',
+    ))
 
-                # Generate values structs
-                values = ''
-                for value in field['values']:
-                    values += f'using {value['name']} = ValueBase<{name}, {value['value']}, Target, Family, {value['name'].lower()}_name>;\t// {value['description']}\n'
-
-                if len(field['values']):
-                    fields += (
-                        f'// {field['description']}\n'
-                        f'template<class Register, size_t offset, size_t width, class Access, class Target, class Family, const char* name>\n'
-                        f'class {name}: public FieldBase<Register, offset, width, Access, Target, Family, name>\n'
-                        f'{{\n'
-                        f'{names}\n'
-                        f'public:\n'
-                        f'{values}\n'
-                        f'}};\n'
-                    )
-                else:
-                    fields += (
-                        f'// {field['description']}\n'
-                        f'template<class Register, size_t offset, size_t width, class Access, class Target, class Family, const char* name>\n'
-                        f'class {name}: public FieldBase<Register, offset, width, Access, Target, Family, name>\n'
-                        f'{{\n'
-                        f'}};\n'
-                    )
-
-
-
-        text = (
-            f'#pragma once\n\n'
-            f'#include "{config['fields']['common']}/FieldBase.h"\n'
-            f'#include "{config['fields']['common']}/ValueBase.h"\n'
-            f'namespace {namespace}::{peripheral['name'].lower()}\n'
-            f'{{\n'
-            f'{fields}\n'
-            f'}}\n'
-        )
+    path = config['cwd'] / config['root']['fields'] / f'{peripheral['name']}.h'
+    with open(path, 'w', encoding='utf-8', buffering=WRITE_BUFFER) as header:
+        header.writelines(text)
 
-        path = Path('.').cwd() / f'{config['root']['fields']}/{peripheral['name']}.h'
-        with open(path, 'w') as header:
-            header.write(text)
+    return path
+
+
+def create_field_files(namespace: str, peripherals: list, config: dict, executor: 'Executor | None'):
+    return map_peripherals(functools.partial(create_field_file, namespace=namespace, config=config), peripherals, executor)
+
+
+def create_driver_file(peripheral: dict, namespace: str, config: dict):
+    text = (
+        f'#pragma once\n\n'
+        f'namespace {namespace}::{peripheral['name'].lower()}\n'
+        f'{{\n'
+        f'template<class {peripheral['name']}>'
+        f'\tclass Driver\n'
+        f'{{\n'
+        f'}};\n'
+        f'}}\n'
+    )
 
-    path = Path('.').cwd() / f'{config['root']['fields']}/*.h'
-    run_clang_format(path)
+    path = config['cwd'] / config['root']['drivers'] / f'{peripheral['name']}.h'
+    write_header(path, text)
+
+    return path
 
 
 def create_driver_files(namespace: str, peripherals: list, config: dict):
+    return [create_driver_file(peripheral, namespace, config) for peripheral in peripherals]
 
-    # Create dir for files
-    Path(config['root']['drivers']).mkdir(parents=True, exist_ok=True)
 
-    for peripheral in peripherals:
-        text = (
-            f'#pragma once\n\n'
-            f'namespace {namespace}::{peripheral['name'].lower()}\n'
-            f'{{\n'
-            f'template<class {peripheral['name']}>'
-            f'\tclass Driver\n'
-            f'{{\n'
-            f'}};\n'
-            f'}}\n'
-        )
+def create_peripheral_file(peripheral: dict, namespace: str, config: dict):
+    registers = []
+    name = peripheral['name']
 
-        path = Path('.').cwd() / f'{config['root']['drivers']}/{peripheral['name']}.h'
-        with open(path, 'w') as header:
-            header.write(text)
+    if peripheral.get('address'):
+        registers.append(f'\tusing Registers = {name}Base<Target, {name}_ADDRESS>;')
+    else:
+        for current_name, _ in peripheral['derived']:
+            registers.append(f'\tusing Registers{current_name} = {name}Base<Target, {current_name}_ADDRESS>;')
+    registers = '\n'.join(registers)
 
-    path = Path('.').cwd() / f'{config['root']['drivers']}/*.h'
-    run_clang_format(path)
+    peripheral_list = []
+    common_name = peripheral['name']
+    driver_namespace = f'{common_name.lower()}'
 
+    if peripheral.get('address'):
+        peripheral_list.append(f'\tstruct {common_name}: {driver_namespace}::Registers {{ using Driver = {driver_namespace}::Driver<{common_name.lower()}::Registers>; }};')
 
-def create_peripheral_files(namespace: str, peripherals: list, config: dict):
+    else:
+        for current_name, _ in peripheral['derived']:
+            peripheral_list.append(f'\tstruct {current_name}: {driver_namespace}::Registers{current_name} {{ using Driver = {driver_namespace}::Driver<{driver_namespace}::Registers{current_name}>; }};')
+    peripheral_list = '\n'.join(peripheral_list)
 
-    Path(config['root']['peripherals']).mkdir(parents=True, exist_ok=True)
+    text = str(
+        f'#pragma once\n\n'
+        f'#include "{config['peripherals']['root']}/{config['address']}"\n'
+        f'#include "{config['peripherals']['root']}/{config['targets']}"\n'
+        f'#include "{config['peripherals']['base']}/{name}.h"\n'
+        f'#include "{config['peripherals']['drivers']}/{name}.h"\n\n'
+        f'namespace {namespace}::{name.lower()}\n'
+        f'{{\n'
+        f'{registers}\n'
+        f'}}\n\n'
+        f'namespace {namespace}\n'
+        f'{{\n'
+        f'\t// clang-format off\n'
+        f'{peripheral_list}\n'
+        f'\t// clang-format on\n'
+        f'}}\n'
+    )
 
-    headers = f'#pragma once\n\n'
-    for peripheral in peripherals:
+    path = config['cwd'] / config['root']['peripherals'] / f'{peripheral['name']}.h'
+    write_header(path, text)
 
-        registers = ''
-        name = peripheral['name']
+    return path
 
-        if peripheral.get('address'):
-            registers += f'\tusing Registers = {name}Base<Target, {name}_ADDRESS>;\n'
-        else:
-            for element in peripheral['derived']:
-                current_name = element['name']
-                registers += f'\tusing Registers{current_name} = {name}Base<Target, {current_name}_ADDRESS>;\n'
 
-        peripheral_list = ''
-        common_name = peripheral['name']
-        driver_namespace = f'{common_name.lower()}'
+def create_peripheral_files(namespace: str, peripherals: list, config: dict):
+
+    files = []
 
-        if peripheral.get('address'):
-            peripheral_list += f'\tstruct {common_name}: {driver_namespace}::Registers {{ using Driver = {driver_namespace}::Driver<{common_name.lower()}::Registers>; }};\n'
+    # Common header collects includes while peripheral headers are written
+    final = config['cwd'] / config['final']
+    with open(final, 'w', encoding='utf-8') as common:
+        common.write('#pragma once\n\n')
+        for peripheral in peripherals:
+            path = create_peripheral_file(peripheral, namespace, config)
+            files.append(path)
+            common.write(f'#include "{config['root']['peripherals']}/{path.name}"\n')
 
-        else:
-            for element in peripheral['derived']:
-                peripheral_list += f'\tstruct {element['name']}: {driver_namespace}::Registers{element['name']} {{ using Driver = {driver_namespace}::Driver<{driver_namespace}::Registers{element['name']}>; }};\n'
-
-        text = str(
-            f'#pragma once\n\n'
-            f'#include "{config['peripherals']['root']}/{config['address']}"\n'
-            f'#include "{config['peripherals']['root']}/{config['targets']}"\n'
-            f'#include "{config['peripherals']['base']}/{name}.h"\n'
-            f'#include "{config['peripherals']['drivers']}/{name}.h"\n\n'
-            f'namespace {namespace}::{name.lower()}\n'
-            f'{{\n'
-            f'{registers[:-1]}\n'
-            f'}}\n\n'
-            f'namespace {namespace}\n'
-            f'{{\n'
-            f'\t// clang-format off\n'
-            f'{peripheral_list[:-1]}\n'
-            f'\t// clang-format on\n'
-            f'}}\n'
-        )
+    files.append(final)
+
+    return files
+
+
+# Templates of simulation storage for registers in addresses file
+REGISTER_STORAGE = 'static inline {ctype} {name} = 0;'
+REGISTER_ARRAY_STORAGE = 'static inline {ctype} {name}[{length}] = {{0}};'
 
-        path = Path('.').cwd() / f'{config['root']['peripherals']}/{peripheral['name']}.h'
-        with open(path, 'w') as header:
-            header.write(text)
-        headers += f'#include "{config['root']['peripherals']}/{name}.h"\n'
+# Templates of storage addresses, struct name is filled per peripheral variant
+REGISTER_STORAGE_ADDRESS = '&{{0}}::{name}'
+REGISTER_ARRAY_STORAGE_ADDRESS = '{{0}}::{name}'
 
-    path = Path('.').cwd() / f'{config['final']}'
-    with open(path, 'w') as common:
-        common.write(headers)
 
-    run_clang_format(path)
+def get_variant_names(peripheral: dict):
+    if peripheral.get('address'):
+        return (peripheral['name'],)
+    return tuple(current_name for current_name, _ in peripheral['derived'])
 
 
 def create_addresses_file(peripherals: list, config: dict):
-    # Generate storage structs
-    structs = ''
-    for peripheral in peripherals:
-        registers = ''
-        for register in peripheral['registers']:
-            width = 'uint8_t' if register['width'] == 8 else 'uint16_t' if register['width'] == 16 else 'uint32_t'
-            registers += f'static inline {width} {register['name']}[{register['length']}] = {{0}};\n' if register['length'] else f'static inline {width} {register['name']} = 0;\n'
-
-        if peripheral.get('address'):
-            structs += (
-                f'struct {peripheral['name']}\n'
-                f'{{\n'
-                f'{registers[:-1]}\n'
-                f'}};\n\n'
-            )
-        else:
-            for elements in peripheral['derived']:
-                structs += (
-                    f'struct {elements['name']}\n'
+    path = config['cwd'] / config['address']
+    with open(path, 'w', encoding='utf-8', buffering=WRITE_BUFFER) as header:
+        header.write(
+            '#pragma once\n\n'
+            '#include <cstdint>\n\n'
+            '#ifdef SIMULATION\n'
+        )
+
+        # Generate storage structs, registers are built once and shared by all variants
+        separator = ''
+        for peripheral in peripherals:
+            registers = '\n'.join(
+                (REGISTER_ARRAY_STORAGE if register['length'] else REGISTER_STORAGE).format_map(register)
+                for register in peripheral['registers'])
+
+            for current_name in get_variant_names(peripheral):
+                header.write(
+                    f'{separator}'
+                    f'struct {current_name}\n'
                     f'{{\n'
-                    f'{registers[:-1]}\n'
-                    f'}};\n\n'
+                    f'{registers}\n'
+                    f'}};'
                 )
+                separator = '\n\n'
 
-    # Generate storage address list
-    storage_address_list = ''
-    for peripheral in peripherals:
-        names = ''
-        if peripheral.get('address'):
-            for register in peripheral['registers']:
-                names += f'{peripheral['name']}::{register['name']}, ' if register['length'] else f'&{peripheral['name']}::{register['name']}, '
-            storage_address_list += f'#define {peripheral['name']}_ADDRESS {names[:-2]}\n'
+        header.write(
+            '\n'
+            '#endif\n\n'
+            '#ifdef SIMULATION\n'
+        )
 
-        else:
-            for element in peripheral['derived']:
-                names = ''
-                for register in peripheral['registers']:
-                    names += f'{element['name']}::{register['name']}, ' if register['length'] else f'&{element['name']}::{register['name']}, '
-                storage_address_list += f'#define {element['name']}_ADDRESS {names[:-2]}\n'
-
-    # Generate default address list
-    address_list = ''
-    for peripheral in peripherals:
-        if peripheral.get('address'):
-            address_list += f'#define {peripheral['name']}_ADDRESS {peripheral['address']}\n'
-        else:
-            for element in peripheral['derived']:
-                address_list += f'#define {element['name']}_ADDRESS {element['address']}\n'
+        # Generate storage address list, names are built once and get the struct name per variant
+        for peripheral in peripherals:
+            names = ', '.join(
+                (REGISTER_ARRAY_STORAGE_ADDRESS if register['length'] else REGISTER_STORAGE_ADDRESS).format_map(register)
+                for register in peripheral['registers'])
 
-    text = str(
-        f'#pragma once\n\n'
-        f'#include <cstdint>\n\n'
-        f'#ifdef SIMULATION\n'
-        f'{structs[:-2]}\n'
-        f'#endif\n\n'
-        f'#ifdef SIMULATION\n'
-        f'{storage_address_list}\n'
-        f'#else\n'
-        f'{address_list}\n'
-        f'#endif\n'
-    )
+            for current_name in get_variant_names(peripheral):
+                header.write(f'#define {current_name}_ADDRESS {names.format(current_name)}\n')
+
+        header.write(
+            '\n'
+            '#else\n'
+        )
 
-    path = Path('.').cwd() / f'{config['address']}'
-    with open(path, 'w') as header:
-        header.write(text)
+        # Generate default address list
+        for peripheral in peripherals:
+            if peripheral.get('address'):
+                header.write(f'#define {peripheral['name']}_ADDRESS {peripheral['address']}\n')
+            else:
+                for current_name, address in peripheral['derived']:
+                    header.write(f'#define {current_name}_ADDRESS {address}\n')
+
+        header.write(
+            '\n'
+            '#endif\n'
+        )
 
-    run_clang_format(path)
+    return [path]
 
 
-def get_peripherals(tree: Et.Element, includes: list):
+def parse_peripherals(source: Path):
+    # Stream peripherals one by one instead of building the whole tree,
+    # skip whitespace nodes and id bookkeeping, allow big vendor files
+    if LXML:
+        return Et.iterparse(
+            str(source), events=('end',), tag='peripheral',
+            remove_comments=True, remove_blank_text=True, collect_ids=False, huge_tree=True)
+    return ((event, element) for event, element in Et.iterparse(str(source), events=('end',)) if element.tag == 'peripheral')
+
+
+def release_element(element: Et.Element):
+    if LXML:
+        element.clear(keep_tail=True)
+        # Drop already processed siblings, they are kept by parent otherwise
+        while element.getprevious() is not None:
+            del element.getparent()[0]
+    else:
+        element.clear()
+
+
+def get_peripherals(context, includes: list):
 
     peripherals = list()
-    for i, branch in enumerate(tree):
 
-        derived = None if tree[i].attrib == {} else tree[i].attrib['derivedFrom'].upper()
-        name = tree[i].find('name').text.upper()
-        addresses = {'name': name, 'address': f'0x{tree[i].find('baseAddress').text.upper()[2:]}'}
-        group = None
-        description = None
-        registers = []
+    # Index of peripheral by its own or derived name
+    indexes = dict()
+    for _, branch in context:
+
+        # Read all children in one pass instead of searching for each of them
+        children = {child.tag: child for child in branch}
+        derived = branch.get('derivedFrom')
+        name = children['name'].text.upper()
+        addresses = (name, f'0x{children['baseAddress'].text.upper()[2:]}')
 
         if derived:
-            i = get_derived_index(derived, peripherals)
+            i = indexes[derived.upper()]
             peripheral = peripherals[i]
             peripheral['derived'].append(addresses)
-            continue
         else:
-            group = tree[i].find('groupName').text.upper()
-            temp = tree[i].find('description').text.capitalize()
-            description = process_description(temp)
-            registers = process_registers(tree[i].find('registers'))
+            group = get_text(children.get('groupName'), name).upper()
+            description = process_description(get_text(children.get('description')))
+            registers = process_registers(name, children.get('registers'))
+            peripherals.append({'group': group, 'derived': [addresses], 'description': description, 'registers': registers})
+            i = len(peripherals) - 1
+        indexes[name] = i
 
-        peripherals.append({'group': group, 'derived': [addresses], 'description': description, 'registers': registers})
+        release_element(branch)
 
-    temp = []
     if includes:
-        for include in includes:
-            for peripheral in peripherals:
-                if include == peripheral['group']:
-                    temp.append(peripheral)
-                    break
-        peripherals = temp.copy()
-        temp.clear()
+        # First peripheral of every group, includes keep their order
+        groups = dict()
+        for peripheral in peripherals:
+            groups.setdefault(peripheral['group'], peripheral)
+        peripherals = [groups[include] for include in includes if include in groups]
+
+    temp = []
 
     for peripheral in peripherals:
         if len(peripheral['derived']) == 1:
-            address = peripheral['derived'][0]['address']
+            address = peripheral['derived'][0][1]
             temp.append({'name': peripheral['group'], 'description': peripheral['description'], 'address': address, 'registers': peripheral['registers']})
         else:
-            derived = sorted(peripheral['derived'], key=lambda item: item['address'])
+            # Derived peripherals are (name, address) pairs sorted by address
+            derived = tuple(sorted(peripheral['derived'], key=itemgetter(1)))
             temp.append({'name': peripheral['group'],'description': peripheral['description'],'derived': derived,'registers': peripheral['registers']})
 
     return temp
 
 
+def save_json(peripherals: list, path: Path):
+    if ORJSON:
+        path.write_bytes(orjson.dumps(peripherals, option=orjson.OPT_INDENT_2))
+    else:
+        path.write_text(json.dumps(peripherals, indent=4), encoding='utf-8')
+
+
+# Files saved by earlier versions keep derived peripherals as {'name', 'address'} objects,
+# register offsets as hex strings and have no precomputed lower names and storage types
+def normalize_peripherals(peripherals: list):
+    for peripheral in peripherals:
+        if 'derived' in peripheral:
+            peripheral['derived'] = tuple(
+                (derived['name'], derived['address']) if isinstance(derived, dict) else tuple(derived)
+                for derived in peripheral['derived'])
+        for register in peripheral['registers']:
+            if isinstance(register['offset'], str):
+                register['offset'] = int(register['offset'], 16)
+            register.setdefault('lower', register['name'].lower())
+            register.setdefault('ctype', CTYPES.get(register['width'], 'uint32_t'))
+            for field in register['fields']:
+                field.setdefault('lower', field['name'].lower())
+                for value in field['values']:
+                    value.setdefault('lower', value['name'].lower())
+    return peripherals
+
+
+def load_json(path: Path):
+    if ORJSON:
+        peripherals = orjson.loads(path.read_bytes())
+    else:
+        peripherals = json.loads(path.read_text(encoding='utf-8'))
+    return normalize_peripherals(peripherals)
+
+
 def get_relative_path(source: Path, target: Path):
     return str(source.relative_to(target, walk_up=True)).replace('\\', '/')
 
@@ -452,19 +599,19 @@ if __name__ == '__main__':
 
     parser = argparse.ArgumentParser()
     parser.add_argument('--include', '-i', nargs='+', help='list of peripherals to include')
-    parser.add_argument('--base', '-b', help='generate base files', nargs='?', const='')
-    parser.add_argument('--fields', '-f', help='generate field files', nargs='?', const='')
-    parser.add_argument('--drivers', '-d', help='generate driver files', nargs='?', const='')
+    parser.add_argument('--base', '-b', help='generate base files', action='store_true')
+    parser.add_argument('--fields', '-f', help='generate field files', action='store_true')
+    parser.add_argument('--drivers', '-d', help='generate driver files', action='store_true')
     parser.add_argument('--source', '-s', help='source file', nargs='?', const='')
-    parser.add_argument('--json', '-j', help='svd to json', nargs='?', const='')
+    parser.add_argument('--json', '-j', help='svd to json', action='store_true')
 
     args = parser.parse_args()
     includes = args.include
-    base = True if args.base == '' else False
-    fields = True if args.fields == '' else False
-    drivers = True if args.drivers == '' else False
+    base = args.base
+    fields = args.fields
+    drivers = args.drivers
     source = Path(args.source)
-    need_json = True if args.json == '' else False
+    need_json = args.json
 
     current = Path('.')
     common_namespace = 'mcu'
@@ -478,19 +625,17 @@ if __name__ == '__main__':
     fields_path = root_path / 'Fields'
 
     if source.suffix == '.svd':
-        tree = Et.parse(source.name)
-        root = tree.getroot()
-        peripherals = get_peripherals(root.find('peripherals'), includes)
+        context = parse_peripherals(source)
+        peripherals = get_peripherals(context, includes)
 
         if need_json:
-            with open(f'{source.stem}.json', 'w') as output:
-                json.dump(peripherals, output, indent=4)
+            save_json(peripherals, Path(f'{source.stem}.json'))
 
     elif source.suffix == '.json':
-        with open(source, 'r') as file:
-            peripherals = json.load(file)
+        peripherals = load_json(source)
 
     config = {
+        'cwd': root_path,
         'base': {
             'root': get_relative_path(root_path, base_path),
             'common': get_relative_path(common_path, base_path),
@@ -524,14 +669,31 @@ if __name__ == '__main__':
         'targets': 'targets.h'
     }
 
-    if base:
-        create_base_files(common_namespace, peripherals, config)
+    # Create output dirs once before generation
+    for key, enabled in (('base', base), ('fields', fields), ('drivers', drivers), ('peripherals', True)):
+        if enabled:
+            (config['cwd'] / config['root'][key]).mkdir(parents=True, exist_ok=True)
+
+    files = []
+
+    # Base and field headers are independent and heavy, generate them in parallel when there are cores and work for it
+    parallel = (base or fields) and (os.cpu_count() or 1) > 1 and len(peripherals) >= PARALLEL_MIN_PERIPHERALS
+    if parallel:
+        from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor() if parallel else nullcontext() as executor:
+        if base:
+            files += create_base_files(common_namespace, peripherals, config, executor)
 
-    if fields:
-        create_field_files(common_namespace, peripherals, config)
+        if fields:
+            files += create_field_files(common_namespace, peripherals, config, executor)
 
+    # Driver and Registers headers are a few lines each, sending peripherals to workers costs more than writing them
     if drivers:
-        create_driver_files(common_namespace, peripherals, config)
+        files += create_driver_files(common_namespace, peripherals, config)
+
+    files += create_peripheral_files(common_namespace, peripherals, config)
+
+    files += create_addresses_file(peripherals, config)
 
-    create_peripheral_files(common_namespace, peripherals, config)
-    create_addresses_file(peripherals, config)
\ No newline at end of file
+    # Format all generated files at once
+    run_clang_format(files, config['cwd'])
\ No newline at end of file